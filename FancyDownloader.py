@@ -19,14 +19,52 @@
 
 from __future__ import annotations
 import pywikibot
-import xml.etree.ElementTree as ET
+import pywikibot.comms.http
+from requests.adapters import HTTPAdapter
+from xml.sax.saxutils import escape
 import os
+import atexit
+import re
+import json
+import tempfile
 import datetime
+import functools
+import itertools
+import threading
+import queue
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import Counter, deque
+from collections.abc import Iterable, Iterator
 
 from Log import Log, LogOpen
 from HelpersPackage import WikiPagenameToWindowsFilename, WindowsFilenameToWikiPagename
 
+# Page downloads are dominated by waiting on the server, so we overlap them using a pool of threads.
+maxDownloadThreads=16
+# At most this many recently-updated pages are queued in the pool at once, so that we can stop soon after stoppingCriterion is reached
+downloadBatchSize=32
+# How many times listing a namespace may fail before we give up on it
+allpagesRetries=3
+# The number of recent changes which are fetched ahead of their use
+recentChangesPrefetch=1000
+# Per-page log messages are collected and written out this many at a time
+pageLogBatchSize=64
+# When we have a list of pages to download, the wiki is asked for this many at a time
+preloadGroupSize=50
+# The timestamp of each local page is cached here so that we don't need to parse every page's .xml file to find it
+timestampIndexFilename=".timestamps.json"
+# The time of the last completed run is kept here so that the next run need only look at the changes since then
+stateFilename=".fancy_state.json"
+# The only thing we need from a local page's .xml file is its timestamp, so we pick it out of the raw bytes rather than parsing the whole file
+timestampPattern=re.compile(rb"<timestamp>([^<]+)</timestamp>")
+# Files are written to (private) temporary files which are then moved into place, so they're given the permissions a newly-created file would have had
+currentUmask=os.umask(0o022)
+os.umask(currentUmask)
+newFileMode=0o666 & ~currentUmask
+# An <a ... href="URL" ...>LINKTEXT</a> link, with the URL and the LINKTEXT as its groups.  Other attributes may come before or after the href.
+hrefPattern=re.compile(r"""<a\b[^>]*?\bhref\s*=\s*(["'])(.*?)\1[^>]*>(.*?)</a>""", re.IGNORECASE | re.DOTALL)
+
 def main():
     # ############################################################################################
     # ###################################  Main  #################################################
@@ -35,6 +73,10 @@ def main():
     # This opens the site specified by user-config.py with the credential in user-password.py.
     fancy=pywikibot.Site()
 
+    # By default, pywikibot's requests session keeps only 10 connections to the wiki open, which is fewer than we have download threads.
+    # Enlarge the pool so that each thread can reuse its own connection rather than opening a new one.
+    pywikibot.comms.http.session.mount("https://", HTTPAdapter(pool_connections=maxDownloadThreads, pool_maxsize=maxDownloadThreads))
+
     # Change the working directory to the destination of the downloaded wiki
     cwd=os.getcwd()
     path=os.path.join(cwd, "..\\site")
@@ -43,25 +85,17 @@ def main():
     del path
 
     LogOpen("Log", "Error", dated=True)
+    # Make sure buffered per-page messages are written even if the run dies with an exception: they name the pages which were just written
+    atexit.register(FlushPageLog)
 
     # Look for a file called "override.txt" -- if it exists, load those pages and do nothing else.
     # Override.txt contains a list of page names, one name per line.
     # if os.path.exists("../FancyDownloader/override.txt"):
+    #     # Remove trailing '\n', blank lines and duplicates (dict.fromkeys preserves the order of the file)
     #     with open("../FancyDownloader/override.txt", "r") as file:
-    #         override=file.readlines()
-    #     override=[x.strip() for x in override]  # Remove trailing '\n'
-    #     # Remove duplicates;
-    #     nodupes=[]
-    #     for x in override:
-    #         if x not in nodupes:
-    #             nodupes.append(x)
-    #     override=nodupes
-    #     del nodupes, x
+    #         override=list(dict.fromkeys(x.strip() for x in file if x.strip()))
     #     Log("Downloading override pages...")
-    #     countDownloadedPages=0
-    #     for wikiPagename in override:
-    #         if DownloadPage(fancy, wikiPagename, None):
-    #             countDownloadedPages+=1
+    #     countDownloadedPages, _=DownloadPages(fancy, override)
     #     exit()
 
     # Get list of pages on the wiki
@@ -72,122 +106,87 @@ def main():
     report: str=""
     Log("Download list of all pages from the wiki")
     wikiPagenames: list[str]=[]
+    wikiListComplete=True       # If any namespace can't be listed completely, we mustn't treat the pages missing from the list as deleted
     for ns in fancy.namespaces:
         # Note that the namespaces are integers, and negative namespaces may be ignored
         if ns < 0 or ns == 6:       #TODO: NS 6 is File:  We need to be able to download it.
             continue
         Log(f"Trying Namespace {ns}: {fancy.namespaces[ns].canonical_name}")
-        try:
-            for page in fancy.allpages(namespace=ns):
-                # Split on the first colon into namespace and page name
-                sv=str(page).strip("[]")  # Drop leading and trailing square brackets
-                assert sv.find(":") > 0
-                parts=sv.split(":", 1)
-                wikiPagenames.append(parts[1])
-        except Exception as e:
-            assert True
+        if not ListNamespacePages(fancy, ns, wikiPagenames):
+            wikiListComplete=False
         Log(f"Namespace {ns} complete. Count of pages={len(wikiPagenames)}")
     s=f"   Number of pages on wiki: {len(wikiPagenames)}"
     Log(s)
     report+=s+"\n"
 
-    Log("Download list of recent pages (those updated in the last 90 days), sorted from most- to least-recently-updated")
+    Log("Request list of recent pages, sorted from most- to least-recently-updated")
     current_time=fancy.server_time()
-    iterator=fancy.recentchanges(start=current_time, end=current_time-timedelta(hours=600000))  # Not for all time, just for the last 3 months...
-    recentWikiPages: list[dict]=[]
-    for v in iterator:
-        recentWikiPages.append(v)
-
-    Log(f"   Downloaded list of changes includes {len(recentWikiPages)} items")
-    # allWikiPages=[val for val in allWikiPages if val["title"] == "Third Foundation"]
-
-    # Get rid of the older instances of each page.
-    # Use a dictionary which only contains the latest version
-    tempDict: dict[str, dict]={}
-    for p in recentWikiPages:
-        pagename=p["title"]
-        if pagename not in tempDict.keys() or p["timestamp"] > tempDict[pagename]["timestamp"]:
-            tempDict[pagename]=p
-
-    # Recreate the listOfAllWikiPages from the de-duped dictionary
-    recentWikiPages: list[dict]=list(tempDict.values())
-    Log("   After de-duping, there are "+str(len(recentWikiPages))+" pages left")
-
-    # Some members of this list are wiki pages referred to in the wiki which have not been created.
-    emptyWikiPagenames=[val for val in recentWikiPages if val["newlen"] == 0]
-    Log("   There are "+str(len(emptyWikiPagenames))+" empty wiki pages")
-
-    # Sort the list of all pages by timestamp
-    def sorttime(page):
-        return page["timestamp"]
-
-    recentWikiPages=sorted(recentWikiPages, key=sorttime, reverse=True)
-    Log("   The oldest page change listed is "+str(recentWikiPages[-1]["timestamp"]))
-
-    # This list includes pages which are referred to in the wiki, but which have not been created yet.  We don't want them.
-    uncreatedWikiPagenames=[val["title"] for val in recentWikiPages if val["oldlen"] == 0 and val["newlen"] == 0]
-    s=f"   There are {len(uncreatedWikiPagenames)} recent pages which are referenced on the wiki, but have not yet been created there. They will be ignored"
-    Log(s)
-    report+=s+"\n"
-
-    recentWikiPagenames=[val["title"] for val in recentWikiPages]
-    createdWikiPagenamesSet=set(recentWikiPagenames)-set(uncreatedWikiPagenames)
-    createdWikiPagenames=list(createdWikiPagenamesSet)
-    s=f"   There are {len(createdWikiPagenames)} recent pages that exist on the wiki"
-    Log(s)
-    report+=s+"\n"
+    # If a previous run completed, we only need the changes made since it started (plus a little overlap for safety)
+    # Otherwise we go back pretty much forever.
+    state=LoadJson(stateFilename)
+    if "lastRecentChangesTime" in state:
+        end_time=pywikibot.Timestamp.fromISOformat(state["lastRecentChangesTime"])-timedelta(hours=1)
+    else:
+        end_time=current_time-timedelta(hours=600000)
+    Log(f"   Listing changes back to {end_time}")
+    # top_only asks the wiki for only the change which made each page's current revision, so the older changes to a page are never sent at all
+    iterator=fancy.recentchanges(start=current_time, end=end_time, top_only=True)
+    # The list is not read here.  It's streamed into the download of recently updated pages (below), which normally stops long before it reaches the end of the list,
+    # so most of the changes never need to be fetched from the wiki at all.
+    # Once that download starts, the next batches of changes are fetched in the background while the pages already listed are being downloaded.
+    recentChangesCounts=Counter()
+    recentChanges=Prefetch(iterator, recentChangesPrefetch)
+    createdRecentWikiPages=LatestChanges(recentChanges, recentChangesCounts)
 
     # Get the list of pages from the local copy of the wiki and use that to create lists of missing pages and deleted pages
     Log("Creating list of local files")
     # Since all local copies of pages must have a .txt file, listOfAllDirPages will contain the file name of each page (less the extension)
     # So we want a list of just those names stripped of the extension
     # We also have to back-convert the filenames to get rid of the ;xxxx; that we used to replace certain special characters.
-    localFilenamesTxt=[p[:-4] for p in os.listdir(".") if p.endswith(".txt")]
-    localFilenamesXml=[p[:-4] for p in os.listdir(".") if p.endswith(".xml")]
+    localFilenamesTxt, localFilenamesXml=ScanLocalFiles()
+    timestamps=LoadTimestampIndex(localFilenamesXml)
 
     # Create a list of all file names that have *both* .txt and .xml files
-    localFilenames=list(set(localFilenamesTxt)&set(localFilenamesXml))  # Union of set of names of xml files and set of names of txt files yields all pages, partial and complete
+    localFilenames: set[str]=localFilenamesTxt&localFilenamesXml  # Intersection of set of names of xml files and set of names of txt files yields all pages, partial and complete
     Log("    There are "+str(len(localFilenames))+" pages which are in the local copy")
 
     # Create a list of all file names that have one or the other but not both.
-    partialLocalFilenames: list[str]=list(set(localFilenamesTxt)^set(localFilenamesXml))  # Symmetric difference yields list of partial local copies of pages
-    partialLocalFilenames=[p for p in partialLocalFilenames if (not p.startswith("Log 202") and not p.startswith("Error 202"))]  # Ignore log files that find there way here
+    partialLocalFilenames: set[str]=localFilenamesTxt^localFilenamesXml  # Symmetric difference yields the partial local copies of pages
     if len(partialLocalFilenames) == 0:
         Log("    There are no partial page downloads")
     else:
         s=f"   There are {len(partialLocalFilenames)} partial page downloads required"
         Log(s)
         report+=s+"\n"
-        for pname in partialLocalFilenames:
-            DownloadPage(fancy, pname, None)
+        DownloadPages(fancy, partialLocalFilenames, timestamps)
 
     # Figure out what pages are missing from the local copy and download them.
     # We do this because we may have at some point failed to make a local copy of a new page.  If it's never updated, it'll never be picked up by the recent changes code.
-    localPagenamesSet: set[str]=set([WindowsFilenameToWikiPagename(val) for val in localFilenames])
+    # Remember the local filename of each page, so a deleted page's files can be found without converting its pagename back
+    localPagenames: dict[str, str]={WindowsFilenameToWikiPagename(val): val for val in localFilenames}
+    localPagenamesSet: set[str]=set(localPagenames)
     wikiPagenamesSet: set[str]=set(wikiPagenames)
-    missingLocalPagenames: list[str]=list(wikiPagenamesSet-localPagenamesSet)
+    missingLocalPagenames: set[str]=wikiPagenamesSet-localPagenamesSet
     s=f"    There are {len(missingLocalPagenames)} pages which are on the wiki but not in the local copy."
     Log(s)
     report+=s+"\n"
 
     # TODO: Really ought to take into account changes with "logtype" == delete, as those are deletions, not updates
-    deletedWikiPagenames=list(localPagenamesSet-wikiPagenamesSet)
-    Log(f"There are {len(deletedWikiPagenames)} pages which are in the local copy, but not on the wiki.")
+    if wikiListComplete:
+        deletedWikiPagenames: set[str]=localPagenamesSet-wikiPagenamesSet
+        Log(f"There are {len(deletedWikiPagenames)} pages which are in the local copy, but not on the wiki.")
+    else:
+        deletedWikiPagenames=set()
+        Log("The list of pages on the wiki is incomplete, so no local pages will be treated as deleted.", isError=True)
 
     # Download pages which exist in the website but not in the disk copy
     Log("Downloading missing pages...")
-    countMissingPages=0
-    countStillMissingPages=0
     if len(missingLocalPagenames) == 0:
         s="   There are no missing pages"
         Log(s)
         report+=s+"\n"
     else:
-        for pname in missingLocalPagenames:
-            if DownloadPage(fancy, pname, None):
-                countMissingPages+=1
-            else:
-                countStillMissingPages+=1
+        countMissingPages, countStillMissingPages=DownloadPages(fancy, missingLocalPagenames, timestamps)
         s=f"   {countMissingPages} missing pages downloaded     {countStillMissingPages} could not be downloaded"
         Log(s)
         report+=s+"\n"
@@ -205,19 +204,44 @@ def main():
     Log("Downloading recently updated pages...")
     countUpToDatePages=0
     countDownloadedPages=0
-    for page in recentWikiPages:
-        pageName=page["title"]
-        if pageName in createdWikiPagenamesSet:
-            if DownloadPage(fancy, pageName, page):
-                countDownloadedPages+=1
-            else:
+    # The pages which are out of date locally are loaded from the wiki in groups, rather than one at a time by DownloadPage
+    recentWikiPages=PreloadStalePages(fancy, createdRecentWikiPages, timestamps)
+    try:
+        # A window of downloadBatchSize pages is kept in the thread pool.  The results are tallied in the order the pages were submitted,
+        # and as soon as stoppingCriterion is reached, the pages which haven't been started yet are cancelled.
+        with ThreadPoolExecutor(max_workers=maxDownloadThreads) as executor:
+            inFlight: deque[Future]=deque()
+            while True:
+                while len(inFlight) < downloadBatchSize and (change := next(recentWikiPages, None)) is not None:
+                    pageData, page=change
+                    inFlight.append(executor.submit(DownloadPage, fancy, pageData["title"], pageData, timestamps, page))
+                if len(inFlight) == 0:
+                    break
+                if inFlight.popleft().result():
+                    countDownloadedPages+=1
+                    continue
                 countUpToDatePages+=1
                 if 0 < stoppingCriterion < countUpToDatePages:
+                    # Count the downloads from pages which were already underway
+                    for future in inFlight:
+                        if not future.cancel() and future.result():
+                            countDownloadedPages+=1
+                    FlushPageLog()
                     s=f"   {countDownloadedPages} updated pages downloaded"
                     Log(s)
                     report+=s+"\n"
                     Log("      Ending downloads. "+str(stoppingCriterion)+" up-to-date pages found")
                     break
+    finally:
+        # We're done with the recent changes, so stop the background thread from fetching any more of them
+        recentChanges.close()
+
+    FlushPageLog()
+    Log(f"   Read {recentChangesCounts['changes']} recent changes to {recentChangesCounts['pages']} pages")
+    Log(f"   There are {recentChangesCounts['empty']} empty wiki pages among them")
+    s=f"   There were {recentChangesCounts['uncreated']} recent pages which are referenced on the wiki, but have not yet been created there. They were ignored"
+    Log(s)
+    report+=s+"\n"
 
     # Optionally, force the download of pages
 
@@ -225,13 +249,7 @@ def main():
     # forcedWikiDownloadsPagenames=[x for x in wikiPagenames if x.lower()[0] == 'v']
     if len(forcedWikiDownloadsPagenames) > 0:
         Log("Begin forced downloading of pages...")
-        countForcedPages=0
-        countStillMissingPages=0
-        for pagename in forcedWikiDownloadsPagenames:
-            if DownloadPage(fancy, pagename, None):
-                countForcedPages+=1
-            else:
-                countStillMissingPages+=1
+        countForcedPages, countStillMissingPages=DownloadPages(fancy, forcedWikiDownloadsPagenames, timestamps)
         s=f"   {countForcedPages} forced pages downloaded     {countStillMissingPages} could not be downloaded"
         Log(s)
         report+=s+"\n"
@@ -243,56 +261,231 @@ def main():
     countOfUndeletedPages=0
     if len(deletedWikiPagenames) == 0:
         Log("   There are no pages to delete")
-    for pname in deletedWikiPagenames:
-        fname=WikiPagenameToWindowsFilename(pname)
-        Log("   Removing: "+pname+" as "+fname, noNewLine=True)
-        deleted=False
-        if os.path.isfile(fname+".xml"):
-            os.remove(fname+".xml")
-            Log(" (.xml)", noNewLine=True)
-            deleted=True
-        if os.path.isfile(fname+".txt"):
-            os.remove(fname+".txt")
-            Log(" (.txt)", noNewLine=True)
-            deleted=True
-        if deleted:
-            countOfDeletedPages+=1
-            Log("  ...gone!")
-        else:
-            countOfUndeletedPages+=1
-            Log("   ( files could not be found)")
+    # The removals are independent, so they are done in parallel
+    with ThreadPoolExecutor(max_workers=maxDownloadThreads) as executor:
+        for deleted in executor.map(lambda pname: RemoveLocalPage(pname, localPagenames[pname]), deletedWikiPagenames):
+            if deleted:
+                countOfDeletedPages+=1
+            else:
+                countOfUndeletedPages+=1
+    FlushPageLog()
 
     s=f"   {countOfDeletedPages} deleted pages removed    {countOfUndeletedPages} could not be found"
     Log(s)
     report+=s+"\n"
 
+    SaveJson(timestampIndexFilename, timestamps)
+
+    # Only now that the run is complete, record where the next run's scan of recent changes can stop
+    state["lastRecentChangesTime"]=str(current_time)
+    SaveJson(stateFilename, state)
+
     Log("Done")
 
     print("\n\n----------------------")
     print(report)
 
+#-----------------------------------------
+# Make a single pass over the current directory and return the names (less the extension) of the .txt files and of the .xml files
+# Using scandir means we can classify the entries from the cached directory information without a stat() per file
+# Log files that find their way here are ignored
+def ScanLocalFiles() -> tuple[set[str], set[str]]:
+    txt: set[str]=set()
+    xml: set[str]=set()
+    with os.scandir(".") as it:
+        for entry in it:
+            name=entry.name
+            if name.startswith(("Log 202", "Error 202")) or not entry.is_file(follow_symlinks=False):
+                continue
+            if name.endswith(".txt"):
+                txt.add(name[:-4])
+            elif name.endswith(".xml"):
+                xml.add(name[:-4])
+    return txt, xml
+
+
+#-----------------------------------------
+# Log a per-page message
+# There may be tens of thousands of these, coming from several threads, so they're buffered and written out a batch at a time by FlushPageLog
+pageLogBuffer: list[str]=[]
+pageLogLock=threading.Lock()
+def LogPage(s: str) -> None:
+    with pageLogLock:
+        pageLogBuffer.append(s)
+        if len(pageLogBuffer) >= pageLogBatchSize:
+            FlushPageLogLocked()
+
+
+# Write out any buffered per-page log messages.  Call this before logging anything which should appear after them.
+def FlushPageLog() -> None:
+    with pageLogLock:
+        FlushPageLogLocked()
+
+
+def FlushPageLogLocked() -> None:
+    if len(pageLogBuffer) > 0:
+        Log("\n".join(pageLogBuffer))
+        pageLogBuffer.clear()
+
+
+#-----------------------------------------
+# Append the names of all the pages in namespace ns to pagenames
+# If the wiki returns an error partway through, the listing is resumed after the last page we got, up to allpagesRetries times
+# Return True if the namespace was listed completely
+def ListNamespacePages(fancy, ns: int, pagenames: list[str]) -> bool:
+    lastSeen: str|None=None     # The last page listed, without its namespace prefix
+    failures=0
+    while True:
+        try:
+            # allpages() starts *at* start, so when resuming we skip the page we've already got
+            for page in fancy.allpages(start=lastSeen or "!", namespace=ns):
+                title=page.title(with_ns=False)
+                if title == lastSeen:
+                    continue
+                # We want the page's name including any namespace prefix (e.g., "Category:Foo"), but without the site prefix str(page) adds
+                pagenames.append(page.title())
+                lastSeen=title
+            return True
+        except pywikibot.exceptions.Error as e:
+            failures+=1
+            Log(f"   Error listing namespace {ns} after '{lastSeen}': {e}", isError=True)
+            if failures > allpagesRetries:
+                Log(f"   Giving up on namespace {ns}", isError=True)
+                return False
+
+
+#-----------------------------------------
+# Run an iterator on a background thread, keeping up to maxsize of its items ready, and return an iterator over the items
+# This lets a slow iterator (e.g., one which fetches pages of results from the wiki) get on with fetching its next items while the consumer works on the ones it has.
+# The background thread is started by the first request for an item.  Any exception raised by the iterator is re-raised in the consumer.
+# A consumer which stops early must close() the returned iterator, which stops the background thread.
+def Prefetch(iterable: Iterable, maxsize: int) -> Iterator:
+    items: queue.Queue=queue.Queue(maxsize=maxsize)
+    stop=threading.Event()
+    done=object()   # Marks the end of the items
+
+    # Put an item on the queue, giving up if the consumer has stopped
+    def Put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def Producer() -> None:
+        try:
+            for item in iterable:
+                if not Put((item, None)):
+                    return
+            Put((done, None))
+        except BaseException as e:
+            Put((done, e))
+
+    def Consumer() -> Iterator:
+        threading.Thread(target=Producer, daemon=True).start()
+        try:
+            while True:
+                item, error=items.get()
+                if error is not None:
+                    raise error
+                if item is done:
+                    return
+                yield item
+        finally:
+            stop.set()
+
+    return Consumer()
+
+
+#-----------------------------------------
+# Pair each recent change with its pywikibot Page if the local copy of the page is out of date, or with None if it is current
+# The changes are taken preloadGroupSize at a time, and the out-of-date pages in each group are loaded from the wiki together
+def PreloadStalePages(fancy, changes: Iterator[dict], timestamps: dict[str, str]) -> Iterator[tuple[dict, pywikibot.Page|None]]:
+    while len(group := list(itertools.islice(changes, preloadGroupSize))) > 0:
+        stalePages: dict[str, pywikibot.Page]={}
+        for change in group:
+            if not LocalCopyIsCurrent(WikiPagenameToWindowsFilename(change["title"]), change["timestamp"], timestamps):
+                stalePages[change["title"]]=pywikibot.Page(fancy, change["title"])
+        # The pages are loaded in place.  Any which can't be loaded are fetched individually by DownloadPage later.
+        for _ in fancy.preloadpages(list(stalePages.values()), groupsize=preloadGroupSize, categories=True):
+            pass
+        for change in group:
+            yield change, stalePages.get(change["title"])
+
+
+#-----------------------------------------
+# Yield the latest change to each created page from a stream of changes supplied by recentchanges()
+# recentchanges() returns the changes newest-first, so the first change we see for a page is its latest version, and the pages come out sorted from most- to least-recently-updated.
+# Since the stream is read lazily, a caller which stops early never causes the rest of the changes to be downloaded.
+# (The wiki is asked for only the latest change to each page, so the de-duplication is just a safety net.)
+# counts accumulates the number of changes read, the number of distinct pages, and how many of those are empty or have not yet been created on the wiki.
+def LatestChanges(changes: Iterable[dict], counts: Counter) -> Iterator[dict]:
+    seen: set[str]=set()
+    for change in changes:
+        counts["changes"]+=1
+        title=change["title"]
+        if title in seen:
+            continue
+        seen.add(title)
+        counts["pages"]+=1
+        if change["newlen"] == 0:
+            counts["empty"]+=1
+            # Some pages are referred to in the wiki, but have not been created yet.  We don't want them.
+            if change["oldlen"] == 0:
+                counts["uncreated"]+=1
+                continue
+        yield change
+
+
+#-----------------------------------------
+# Load a dictionary saved by SaveJson.  If the file is missing or unreadable, return an empty dictionary.
+def LoadJson(filename: str) -> dict:
+    try:
+        with open(filename, "r", encoding="utf8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+# Save a dictionary as json.  Write to a temporary file and then replace so that an interrupted write can't corrupt the file.
+# These files are written only once a run, so the data is also forced to disk before the replace; otherwise a crash could leave an empty file in place of the old one.
+def SaveJson(filename: str, data: dict) -> None:
+    WriteFileAtomic(filename, json.dumps(data).encode("utf8"), sync=True)
+
+
+# Load the cached local page timestamps (a dictionary of local filename -> timestamp)
+# Entries for pages whose .xml file is no longer present are dropped, so the index can never claim that a missing page is up-to-date
+def LoadTimestampIndex(localFilenamesXml: set[str]) -> dict[str, str]:
+    return {k: v for k, v in LoadJson(timestampIndexFilename).items() if k in localFilenamesXml}
+
+
 #-----------------------------------------
 # Find text bracketed by <b>...</b>
 # Input is of the form <b stuff>stuff</b>stuff
 # Return the contents of the first pair of brackets found, the remainder of the input string up to </b>, and anything leftover afterwards (the three stuffs)
 def FindBracketedText(s: str, b: str) -> tuple[str, str,str]|None:
-    strlower=s.lower()
-    # Find <b ...>
-    l1=strlower.find("<"+b.lower()) # Look for <b
-    if l1 == -1:
+    openPattern, bracketPattern=BracketPatterns(b)
+    m=bracketPattern.search(s)
+    if m is not None:
+        return m.group(1), m.group(2), s[m.end():]
+
+    # No complete <b ...>...</b>.  Figure out why.
+    l1=openPattern.search(s)     # Look for <b
+    if l1 is None:
         return "", "", s
-    l2=strlower.find(">", l1)       # Look for following >
-    if l2 == -1:
-        Log("***Error: no terminating '>' found in "+strlower+"'", isError=True)
-        return None
-    s1=s[l1+len(b)+2:l2]
+    if s.find(">", l1.end()) == -1:
+        Log("***Error: no terminating '>' found in "+s.lower()+"'", isError=True)
+    return None
 
-    # Find text between <b ...> and </b>
-    l3=strlower.find("</"+b.lower()+">", l2+1)
-    if l3 == -1:
-        return None
 
-    return s1, s[l2+len(b):l3], s[l3+len(b)+3:]
+# The compiled patterns used by FindBracketedText, cached by tag.  They're case-insensitive, so there's no need to lower-case the string being searched.
+# The tag must end at a word boundary, so that looking for <a> doesn't find <abbr> or <aside>.
+@functools.lru_cache(maxsize=None)
+def BracketPatterns(b: str) -> tuple[re.Pattern, re.Pattern]:
+    tag=re.escape(b)
+    return re.compile(rf"<{tag}\b", re.IGNORECASE), re.compile(rf"<{tag}\b\s*([^>]*)>(.*?)</{tag}>", re.IGNORECASE | re.DOTALL)
 
 
 #-------------------------------------
@@ -300,28 +493,34 @@ def FindBracketedText(s: str, b: str) -> tuple[str, str,str]|None:
 # The structure is "<a href='URL'>LINKTEXT</a>
 # We want to extract the URL and LINKTEXT
 def GetHrefAndTextFromString(s: str) -> tuple[str|None, str|None]:
-    s=FindBracketedText(s, "a")
-    if s[0] == "":
+    m=hrefPattern.search(s)
+    if m is None:
         return None, None
-
-    # Remove the 'href="' from trailing '"' from the string
-    return s[0][6:-1], s[1]
+    return m.group(2), m.group(3)
 
 
-def DecodeDatetime(dtstring: str) -> datetime:
+# Decode a datetime of the form YYYY-MM-DDTHH:MM:SS+00:00
+# The format is fixed, so it's decoded by the (fast, C-level) fromisoformat() rather than the general-purpose strptime()
+# The same timestamps turn up over and over, and datetimes are immutable, so the results are cached
+@functools.lru_cache(maxsize=4096)
+def DecodeDatetime(dtstring: str) -> datetime.datetime:
     if dtstring is None:
         return datetime.datetime(1950, 1, 1, 1, 1, 1)    # If there's no datetime, return something early
-    if not dtstring.endswith("+00:00"):
+    if len(dtstring) != 25 or not dtstring.endswith("+00:00"):
         raise ValueError("Could not decode datetime: '"+dtstring+"'")
-    return datetime.datetime.strptime(dtstring[:-6], '%Y-%m-%dT%H:%M:%S')
+    return datetime.datetime.fromisoformat(dtstring[:-6])     # Drop the "+00:00" so the result stays naive, as before
 
 
 # Download a page from Mediawiki and possibly store it locally.
 # The page's contents are stored in their files, the source in <saveName>.txt, the rendered HTML in <saveName>..html, and all the page meta information in <saveName>.xml
 # Setting pageData to None forces downloading of the page, reghardless of whether it is already stored locally.  This is mostly useful to overwrite the hidden consequences of old sync errors
+# timestamps is the index of local page timestamps.  It is consulted in preference to the page's .xml file and updated when the page is downloaded.
+# page may be supplied if the page has already been loaded from the wiki (e.g., by preloadpages())
 # The return value is True when the local version of the page has been updated, and False otherwise
-def DownloadPage(fancy, wikiPagename: str, pageData: dict|None) -> bool:
+def DownloadPage(fancy, wikiPagename: str, pageData: dict|None, timestamps: dict[str, str]|None=None, page: pywikibot.Page|None=None) -> bool:
     localFilename=WikiPagenameToWindowsFilename(wikiPagename)   # Get the windows filesystem compatible versions of the pagename
+    txtFilename=localFilename+".txt"
+    xmlFilename=localFilename+".xml"
 
     # If we set updateAll to True, then we skip the date che    cks and always do the update
     action="Downloading"
@@ -331,78 +530,199 @@ def DownloadPage(fancy, wikiPagename: str, pageData: dict|None) -> bool:
         # It will not detect incompletely downloaded pages if the xml file exists
         # Check the timestamps and only update if the page on the server is newer than the local copy
 
-        # Get the updated time for the local version
-        if os.path.isfile(localFilename+".xml"):
-            # If no xml file exists, we want to do the download, since the local copy is missing or incomplete
-            tree=ET.parse(localFilename+".xml")
-            doc=tree.getroot()
-            localTimestamp=doc.find("timestamp").text
-
-            # Get the wiki page's updated time
-            wikiTimestamp=pageData["timestamp"]
-
-            # We return True whenever we have just downloaded a page which was already up-to-date locally
-            if wikiTimestamp <= localTimestamp:
-                return False
+        # If no xml file exists, we want to do the download, since the local copy is missing or incomplete
+        if LocalCopyIsCurrent(localFilename, pageData["timestamp"], timestamps):
+            return False
 
     # OK, we're going to download this one
     if wikiPagename == localFilename:
-        Log("   "+action+": '"+wikiPagename+"'")
+        LogPage("   "+action+": '"+wikiPagename+"'")
     else:
-        Log("   "+action+": '"+wikiPagename+"' as '"+localFilename+"'")
+        LogPage("   "+action+": '"+wikiPagename+"' as '"+localFilename+"'")
 
-    page=pywikibot.Page(fancy, wikiPagename)
+    if page is None:
+        page=pywikibot.Page(fancy, wikiPagename)
     if page.text is None or len(page.text) == 0:
-        Log("       empty page: "+wikiPagename)
+        LogPage("       empty page: "+wikiPagename)
 
     # Write the page source to <wikiPagename>.txt
     text=page.text
     if text is not None:
-        with open(localFilename+".txt", "wb") as file:
-            file.write(text.encode("utf8"))
+        WriteFileIfChanged(txtFilename, text.encode("utf8"))
     else:
         # If there's no text, delete any existing txt file
-        if os.path.exists(localFilename+".txt"):
-            os.remove(localFilename+".txt")
+        try:
+            os.remove(txtFilename)
+        except FileNotFoundError:
+            pass
 
     # Write the page's metadata to <wikiPagename>.xml
-    SaveMetadata(localFilename+".xml", page)
+    # This is written last: it holds the timestamp which marks the local copy as up-to-date, so if we're interrupted before this the page will be downloaded again
+    timestamp=SaveMetadata(xmlFilename, page)
+    if timestamps is not None:
+        timestamps[localFilename]=timestamp
 
     # Is this a file?
     if page.is_filepage():
         # Then download it.
         _, filename=wikiPagename.split(":")
         pywikibot.FilePage(fancy, filename).download(filename)
-        Log("       "+filename+" downloaded")
+        LogPage("       "+filename+" downloaded")
+
+
+    return True
 
 
+# Write data to a file (atomically, using WriteFileAtomic), unless the file already contains exactly that data (e.g., after a null edit or a forced download of an up-to-date page)
+# A file of a different size can't match, so it is only read when the sizes are the same
+# Return True if the file was written
+def WriteFileIfChanged(filename: str, data: bytes) -> bool:
+    try:
+        with open(filename, "rb") as file:
+            if os.fstat(file.fileno()).st_size == len(data) and file.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+
+    WriteFileAtomic(filename, data)
     return True
 
 
+# Write data to a temporary file which then replaces filename, so an interrupted run can't leave a half-written file behind
+# Each write gets its own uniquely-named temporary file: two pages can map to the same local file (e.g., titles differing only in case on Windows),
+# and they may be written at the same time by different download threads.
+# If sync is True, the data is forced to disk before it replaces filename
+def WriteFileAtomic(filename: str, data: bytes, sync: bool=False) -> None:
+    fd, tempFilename=tempfile.mkstemp(dir=os.path.dirname(filename) or ".", suffix=".tmp")
+    try:
+        try:
+            WriteAll(fd, data)
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.chmod(tempFilename, newFileMode)
+        os.replace(tempFilename, filename)
+    except BaseException:
+        try:
+            os.remove(tempFilename)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+# Write all of data to an open file descriptor.  os.write() may take only part of the data, so we loop until it has all been written.
+# The data is all in hand, so we write it straight to the file descriptor rather than through Python's buffered file objects
+def WriteAll(fd: int, data: bytes) -> None:
+    view=memoryview(data)
+    while len(view) > 0:
+        view=view[os.write(fd, view):]
+
+
+# Download a list of pages, forcing the download of each
+# The pages' text, revision info and categories are fetched from the wiki preloadGroupSize pages per request, and the pages are then saved using a pool of threads
+# The preload skips pages it can't load (e.g., invalid titles) and needn't hand back pages whose titles the wiki normalised, so any page it doesn't return is loaded by DownloadPage itself
+# Return the count of pages downloaded and the count which could not be downloaded
+def DownloadPages(fancy, wikiPagenames: Iterable[str], timestamps: dict[str, str]|None=None) -> tuple[int, int]:
+    pages: dict[pywikibot.Page, str]={pywikibot.Page(fancy, pagename): pagename for pagename in wikiPagenames}
+    unloadedPages: dict[pywikibot.Page, str]=dict(pages)
+    futures: list[tuple[str, Future]]=[]
+    with ThreadPoolExecutor(max_workers=maxDownloadThreads) as executor:
+        for page in fancy.preloadpages(list(pages), groupsize=preloadGroupSize, categories=True):
+            if page in unloadedPages:
+                pagename=unloadedPages.pop(page)
+                futures.append((pagename, executor.submit(DownloadPage, fancy, pagename, None, timestamps, page)))
+        futures+=[(pagename, executor.submit(DownloadPage, fancy, pagename, None, timestamps)) for pagename in unloadedPages.values()]
+    FlushPageLog()
+
+    countDownloaded=0
+    for pagename, future in futures:
+        try:
+            if future.result():
+                countDownloaded+=1
+        except pywikibot.exceptions.Error as e:
+            Log(f"   Could not download '{pagename}': {e}", isError=True)
+    return countDownloaded, len(futures)-countDownloaded
+
+
+# Is the local copy of a page at least as recent as the wiki's timestamp for it?
+# The updated time for the local version comes from the index of timestamps, falling back to the page's xml file if it isn't in the index
+# A page with no local xml file is never current
+def LocalCopyIsCurrent(localFilename: str, wikiTimestamp: str, timestamps: dict[str, str]|None) -> bool:
+    localTimestamp=timestamps.get(localFilename) if timestamps is not None else None
+    if localTimestamp is None:
+        localTimestamp=ReadLocalTimestamp(localFilename+".xml")
+        if localTimestamp is None:
+            return False
+        # Remember it, so that this page's xml file need never be read again
+        if timestamps is not None:
+            timestamps[localFilename]=localTimestamp
+    return wikiTimestamp <= localTimestamp
+
+
+# Remove the local copy of a page which has been deleted from the wiki
+# The return value is True if any of its files were removed, and False if none could be found
+def RemoveLocalPage(wikiPagename: str, localFilename: str) -> bool:
+    message="   Removing: "+wikiPagename+" as "+localFilename
+    deleted=False
+    for ext in (".xml", ".txt"):
+        try:
+            os.remove(localFilename+ext)
+        except FileNotFoundError:
+            continue
+        message+=" ("+ext+")"
+        deleted=True
+    if deleted:
+        LogPage(message+"  ...gone!")
+    else:
+        LogPage(message+"   ( files could not be found)")
+    return deleted
+
+
+# Read the timestamp from a local page's .xml file.  Return None if there is no such file or it has no timestamp.
+def ReadLocalTimestamp(xmlFilename: str) -> str|None:
+    try:
+        with open(xmlFilename, "rb") as file:
+            m=timestampPattern.search(file.read())
+    except FileNotFoundError:
+        return None
+    if m is None:
+        return None
+    return m.group(1).decode("utf8")
+
+
 # Save the wiki page's metadata to an xml file
-def SaveMetadata(localName: str, pageData: pywikibot.page) -> None:
-    root = ET.Element("data")
-
-    ET.SubElement(root, "title").text=str(pageData.title())
-    ET.SubElement(root, "filename").text=str(pageData.title(as_filename=True))
-    ET.SubElement(root, "urlname").text=str(pageData.title(as_url=True))
-    ET.SubElement(root, "isRedirectPage").text=str(pageData.isRedirectPage())
-    ET.SubElement(root, "numrevisions").text=str(len(pageData._revisions))
-    ET.SubElement(root, "pageid").text=str(pageData.pageid)
-    ET.SubElement(root, "revid").text=str(pageData._revid)
-    ET.SubElement(root, "edittime").text=str(pageData.latest_revision.timestamp)
-    ET.SubElement(root, "permalink").text=str(pageData.permalink())
-
-    ET.SubElement(root, "categories").text=str([c for c in pageData.categories()])
-    #ET.SubElement(root, "backlinks").text=str([c for c in pageData.backlinks()])
-    #ET.SubElement(root, "linkedPages").text=str([c for c in pageData.linkedPages()])
-
-    ET.SubElement(root, "timestamp").text=str(pageData.latest_revision.timestamp)
-    ET.SubElement(root, "user").text=str(pageData.latest_revision.user)
+# The layout is fixed and flat, so the xml is written directly rather than by building an ElementTree
+# Return the page timestamp which was saved
+def SaveMetadata(localName: str, pageData: pywikibot.page) -> str:
+    # Fetch each of these once: pywikibot may need to go to the wiki to get them
+    latestRevision=pageData.latest_revision
+    # When the categories have been preloaded, they come back as an unordered set of plain Pages, so we turn them back into the Categories, sorted by their
+    # underscored titles, which the wiki returns when asked for a single page's categories.  This keeps unchanged metadata byte-for-byte unchanged.
+    categories=sorted((pywikibot.Category(c) for c in pageData.categories()), key=lambda c: c.title(underscore=True, with_ns=False))
+
+    fields: list[tuple[str, object]]=[
+        ("title", pageData.title()),
+        ("filename", pageData.title(as_filename=True)),
+        ("urlname", pageData.title(as_url=True)),
+        ("isRedirectPage", pageData.isRedirectPage()),
+        ("numrevisions", len(pageData._revisions)),
+        ("pageid", pageData.pageid),
+        ("revid", pageData._revid),
+        ("edittime", latestRevision.timestamp),
+        ("permalink", pageData.permalink()),
+        ("categories", categories),
+        #("backlinks", [c for c in pageData.backlinks()]),
+        #("linkedPages", [c for c in pageData.linkedPages()]),
+        ("timestamp", latestRevision.timestamp),
+        ("user", latestRevision.user),
+    ]
+    xml="<data>"+"".join(f"<{tag}>{escape(str(value))}</{tag}>" for tag, value in fields)+"</data>"
 
     # And write the xml out to file <localName>.xml.
-    tree = ET.ElementTree(root)
-    tree.write(localName)
+    # If the metadata hasn't changed, the file is left alone
+    WriteFileIfChanged(localName, xml.encode("utf8"))
+    return str(latestRevision.timestamp)
 
 
 